@@ -0,0 +1,19 @@
+#!/bin/sh
+# Precompile the ESP32 sources to .mpy bytecode with mpy-cross.
+#
+# -O3 strips asserts and line info; -march=xtensawin is required because
+# tuya.py and main.py use the native/viper emitters. The firmware only
+# auto-runs main.py from source, so main.py is compiled as alarm.mpy and
+# a two-line main.py stub imports it. mpy-cross must be the same version as
+# the flashed firmware, which rejects .mpy files from newer compilers.
+set -e
+cd "$(dirname "$0")"
+mkdir -p build
+
+for name in tuya config; do
+    mpy-cross -O3 -march=xtensawin -o "build/$name.mpy" "$name.py"
+done
+mpy-cross -O3 -march=xtensawin -o build/alarm.mpy main.py
+printf 'import alarm\nalarm.main()\n' > build/main.py
+
+echo "Built: $(ls build)"
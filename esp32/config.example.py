@@ -10,6 +10,15 @@ STATIC_START_HOUR = 7
 STATIC_START_MINUTE = 30
 RAMP_DURATION_MINUTES = 30
 
+# Power saving (opt-in): deep sleep between ramps makes the REPL unreachable
+# while asleep; light sleep between ramp updates powers the radio down and can
+# drop the WiFi association or bulb connection on some boards
+DEEP_SLEEP = False
+RAMP_LIGHT_SLEEP = False
+
+# NTP server (defaults to pool.ntp.org). Your router often serves NTP too:
+# NTP_HOST = "192.168.1.1"
+
 # Sunrise mode settings
 LATITUDE = 38.9072
 LONGITUDE = -77.0369
@@ -27,13 +36,11 @@ DEVICES = [
     },
 ]
 
-# Sunrise color/brightness curve (percent -> brightness, color_temp)
-SUNRISE_CURVE = [
-    (0,   10,   0),    # pre-dawn deep red
-    (15,  50,   50),   # first light orange
-    (30,  150,  150),  # dawn orange-yellow
-    (50,  400,  300),  # sun cresting yellow
-    (70,  700,  450),  # early morning warm white
-    (85,  900,  550),  # morning light
-    (100, 1000, 650),  # full daylight
-]
+# Sunrise color/brightness curve as parallel keyframe tuples
+# (percent -> brightness, color_temp). Tuples stay constant when precompiled to .mpy.
+#            pre-dawn  first    dawn     sun       early    morning  full
+#            deep red  light    orange-  cresting  morning  light    daylight
+#                      orange   yellow   yellow    white
+CURVE_PCT = (0,        15,      30,      50,       70,      85,      100)
+CURVE_BRI = (10,       50,      150,     400,      700,     900,     1000)
+CURVE_TMP = (0,        50,      150,     300,      450,     550,     650)
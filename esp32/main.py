@@ -1,8 +1,14 @@
 import network
-import ntptime
+import socket
+import ustruct as struct
 import time
 import urequests
+import ujson as json
+import math
 import gc
+import machine
+import micropython
+from array import array
 from machine import RTC
 
 import config
@@ -37,108 +43,331 @@ def connect_wifi():
         return False
 
 
-def sync_time():
-    """Sync time via NTP."""
+NTP_HOST = "pool.ntp.org"
+NTP_SYNC_MIN_SECS = 3600
+NTP_SYNC_MAX_SECS = 7 * 86400
+NTP_DRIFT_OK_MS = 2000  # Back off syncing while drift between syncs stays under this
+
+# Seconds from the NTP epoch (1900) to the port's epoch (1970 or 2000)
+NTP_DELTA = 2208988800 if time.gmtime(0)[0] == 1970 else 3155673600
+
+
+def rtc_ms():
+    """Current RTC time in milliseconds since the epoch."""
+    return time.time_ns() // 1000000
+
+
+def ntp_ms(msg, offset):
+    """Read the NTP timestamp at offset as milliseconds since the epoch."""
+    secs, frac = struct.unpack_from("!II", msg, offset)
+    return (secs - NTP_DELTA) * 1000 + ((frac * 1000) >> 32)
+
+
+def ntp_address(state):
+    """NTP server address, resolved once and cached in state across deep sleep."""
+    ip = state.get("ntp_ip")
+    if ip is None:
+        host = getattr(config, 'NTP_HOST', NTP_HOST)
+        ip = socket.getaddrinfo(host, 123)[0][-1][0]
+        state["ntp_ip"] = ip
+    return (ip, 123)
+
+
+def ntp_offset_ms(addr):
+    """Measure the RTC offset from NTP, correcting for round-trip delay."""
+    query = bytearray(48)
+    query[0] = 0x1B  # LI=0, version 3, client mode
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.settimeout(1)
+        t1 = rtc_ms()
+        s.sendto(query, addr)
+        msg = s.recv(48)
+        t4 = rtc_ms()
+    finally:
+        s.close()
+
+    if len(msg) < 48:
+        raise OSError("short NTP response")
+    if msg[0] & 7 != 4:
+        raise OSError("NTP response not in server mode")
+    if msg[1] == 0:
+        raise OSError("NTP kiss-of-death response")
+    if msg[40:48] == b"\x00" * 8:
+        raise OSError("NTP response has no transmit time")
+    t2 = ntp_ms(msg, 32)  # Server receive time
+    t3 = ntp_ms(msg, 40)  # Server transmit time
+    return ((t2 - t1) + (t3 - t4)) // 2
+
+
+def sync_due(state):
+    """Whether the adaptive NTP sync interval (or failure back-off) has elapsed."""
+    retry_at = state.get("ntp_retry_at")
+    if retry_at is not None:
+        return time.time() >= retry_at
+    last = state.get("ntp_last")
+    return last is None or time.time() - last >= state.get("ntp_interval", NTP_SYNC_MIN_SECS)
+
+
+def sync_time(state):
+    """Sync time via NTP and adapt the sync interval to the measured drift."""
     print("Syncing time via NTP...")
+    cached = "ntp_ip" in state
     try:
-        ntptime.settime()
-        rtc = RTC()
-        dt = rtc.datetime()
-        print(f"Time synced: {dt[0]}-{dt[1]:02d}-{dt[2]:02d} {dt[4]:02d}:{dt[5]:02d}:{dt[6]:02d} UTC")
-        return True
+        try:
+            offset = ntp_offset_ms(ntp_address(state))
+        except OSError:
+            # A cached server may have gone away; resolve again and retry once.
+            # A freshly resolved one just failed, so there's nothing to gain.
+            if not cached:
+                raise
+            del state["ntp_ip"]
+            offset = ntp_offset_ms(ntp_address(state))
+        ms = rtc_ms() + offset
+        tm = time.gmtime(ms // 1000)
+        RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], (ms % 1000) * 1000))
     except Exception as e:
-        print(f"NTP sync failed: {e}")
+        # Back off so an unreachable server isn't retried on every loop pass
+        state["ntp_retry_at"] = time.time() + NTP_SYNC_MIN_SECS
+        print(f"NTP sync failed: {e} (retrying in {NTP_SYNC_MIN_SECS}s)")
         return False
 
+    # The offset since the last sync is the drift accumulated over the interval:
+    # double the interval while it stays small, halve it otherwise
+    interval = state.get("ntp_interval", NTP_SYNC_MIN_SECS)
+    if state.get("ntp_last") is None:
+        interval = NTP_SYNC_MIN_SECS
+    elif abs(offset) < NTP_DRIFT_OK_MS:
+        interval = min(interval * 2, NTP_SYNC_MAX_SECS)
+    else:
+        interval = max(interval // 2, NTP_SYNC_MIN_SECS)
+    state["ntp_last"] = time.time()
+    state["ntp_interval"] = interval
+    state.pop("ntp_retry_at", None)
+
+    dt = RTC().datetime()
+    print(f"Time synced: {dt[0]}-{dt[1]:02d}-{dt[2]:02d} {dt[4]:02d}:{dt[5]:02d}:{dt[6]:02d} UTC "
+          f"(offset {offset}ms, next sync in {interval}s)")
+    return True
 
-def get_sunrise_time():
-    """Fetch sunrise time from API."""
-    url = f"https://api.sunrise-sunset.org/json?lat={config.LATITUDE}&lng={config.LONGITUDE}&formatted=0"
 
+SUNRISE_CACHE_PATH = "/sunrise_cache.json"
+SUNRISE_CACHE_DAYS = 7
+
+
+def load_sunrise_cache():
+    """Load cached UTC sunrise times ("HH:MM:SS") keyed by local date."""
     try:
-        print("Fetching sunrise time...")
-        response = urequests.get(url)
-        data = response.json()
-        response.close()
-
-        if data["status"] == "OK":
-            sunrise_str = data["results"]["sunrise"]
-            time_part = sunrise_str.split("T")[1].split("+")[0].split("-")[0]
-            hour, minute, second = map(int, time_part.split(":"))
-
-            # Convert UTC to local time
-            hour += config.TIMEZONE_OFFSET
-            if hour < 0:
-                hour += 24
-            elif hour >= 24:
-                hour -= 24
-
-            print(f"Sunrise (local): {hour:02d}:{minute:02d}:{second:02d}")
-            return (hour, minute, second)
-    except Exception as e:
-        print(f"Failed to fetch sunrise: {e}")
+        with open(SUNRISE_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("location") != [config.LATITUDE, config.LONGITUDE]:
+        return {}
+    return cache.get("sunrise", {})
+
+
+def save_sunrise_cache(sunrise):
+    """Write cached sunrise times for the configured location."""
+    try:
+        with open(SUNRISE_CACHE_PATH, "w") as f:
+            json.dump({"location": [config.LATITUDE, config.LONGITUDE], "sunrise": sunrise}, f)
+    except OSError as e:
+        print(f"Failed to write sunrise cache: {e}")
+
+
+def fetch_sunrise_utc(date_str):
+    """Fetch the UTC sunrise time ("HH:MM:SS") for a date from the API."""
+    url = f"https://api.sunrise-sunset.org/json?lat={config.LATITUDE}&lng={config.LONGITUDE}&date={date_str}&formatted=0"
+
+    response = urequests.get(url)
+    data = response.json()
+    response.close()
+
+    if data["status"] != "OK":
+        return None
+    sunrise_str = data["results"]["sunrise"]
+    return sunrise_str.split("T")[1].split("+")[0].split("-")[0]
+
+
+def local_time(days_ahead=0):
+    """Local time tuple from time.localtime(), optionally some days ahead."""
+    return time.localtime(time.time() + config.TIMEZONE_OFFSET * 3600 + days_ahead * 86400)
+
+
+def local_date_str(days_ahead=0):
+    """Local date as YYYY-MM-DD, optionally some days ahead."""
+    t = local_time(days_ahead)
+    return f"{t[0]:04d}-{t[1]:02d}-{t[2]:02d}"
 
-    return (7, 0, 0)
 
+def compute_sunrise(lat, lon, yday):
+    """Compute UTC sunrise (hour, minute, second) from NOAA's solar equations.
 
-def interpolate_curve(curve, percent):
+    Raises ValueError when the sun doesn't rise or set that day (polar regions).
+    """
+    g = 2 * math.pi / 365 * (yday - 1)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(g) - 0.032077 * math.sin(g)
+                       - 0.014615 * math.cos(2 * g) - 0.040849 * math.sin(2 * g))
+    decl = (0.006918 - 0.399912 * math.cos(g) + 0.070257 * math.sin(g)
+            - 0.006758 * math.cos(2 * g) + 0.000907 * math.sin(2 * g)
+            - 0.002697 * math.cos(3 * g) + 0.00148 * math.sin(3 * g))
+
+    lat_r = math.radians(lat)
+    cos_ha = math.cos(math.radians(90.833)) / (math.cos(lat_r) * math.cos(decl)) - math.tan(lat_r) * math.tan(decl)
+    ha = math.degrees(math.acos(cos_ha))
+
+    secs = int((720 - 4 * (lon + ha) - eqtime) * 60) % 86400
+    return (secs // 3600, (secs % 3600) // 60, secs % 60)
+
+
+def get_cached_sunrise_utc():
+    """Get today's UTC sunrise from the cache, fetching a week from the API on a miss."""
+    today = local_date_str()
+    cache = load_sunrise_cache()
+
+    if today not in cache:
+        print("Fetching sunrise times...")
+        fetched = {}
+        for d in range(SUNRISE_CACHE_DAYS):
+            date_str = local_date_str(d)
+            try:
+                time_part = fetch_sunrise_utc(date_str)
+            except Exception as e:
+                print(f"Failed to fetch sunrise: {e}")
+                break
+            if time_part is None:
+                break
+            fetched[date_str] = time_part
+        if fetched:
+            cache = fetched
+            save_sunrise_cache(cache)
+
+    if today not in cache:
+        return None
+    return tuple(map(int, cache[today].split(":")))
+
+
+def get_sunrise_time():
+    """Get today's local sunrise time, computed offline with the API as fallback."""
+    try:
+        hour, minute, second = compute_sunrise(config.LATITUDE, config.LONGITUDE, local_time()[7])
+    except ValueError:
+        sunrise_utc = get_cached_sunrise_utc()
+        if sunrise_utc is None:
+            return (7, 0, 0)
+        hour, minute, second = sunrise_utc
+
+    # Convert UTC to local time
+    hour += config.TIMEZONE_OFFSET
+    if hour < 0:
+        hour += 24
+    elif hour >= 24:
+        hour -= 24
+
+    print(f"Sunrise (local): {hour:02d}:{minute:02d}:{second:02d}")
+    return (hour, minute, second)
+
+
+def get_curve():
+    """Sunrise curve as parallel (percents, brightnesses, color_temps) tuples."""
+    if hasattr(config, 'CURVE_PCT'):
+        return config.CURVE_PCT, config.CURVE_BRI, config.CURVE_TMP
+    # Older configs list (percent, brightness, color_temp) keyframes
+    curve = config.SUNRISE_CURVE
+    return tuple(p[0] for p in curve), tuple(p[1] for p in curve), tuple(p[2] for p in curve)
+
+
+@micropython.native
+def interpolate_curve(pct_arr, bri_arr, tmp_arr, percent):
     """Interpolate brightness and color_temp from curve."""
-    prev_point = curve[0]
-    next_point = curve[-1]
+    prev = 0
+    nxt = len(pct_arr) - 1
 
-    for i, point in enumerate(curve):
-        if point[0] >= percent:
-            next_point = point
-            prev_point = curve[max(0, i - 1)]
-            break
+    if pct_arr[0] >= percent:
+        nxt = 0
+    else:
+        for i in range(1, len(pct_arr)):
+            if pct_arr[i] >= percent:
+                prev = i - 1
+                nxt = i
+                break
 
-    if prev_point[0] == next_point[0]:
-        return prev_point[1], prev_point[2]
+    if pct_arr[prev] == pct_arr[nxt]:
+        return bri_arr[prev], tmp_arr[prev]
 
-    range_pct = next_point[0] - prev_point[0]
-    local_pct = (percent - prev_point[0]) / range_pct
+    range_pct = pct_arr[nxt] - pct_arr[prev]
+    local_pct = (percent - pct_arr[prev]) / range_pct
 
-    brightness = int(prev_point[1] + (next_point[1] - prev_point[1]) * local_pct)
-    color_temp = int(prev_point[2] + (next_point[2] - prev_point[2]) * local_pct)
+    brightness = int(bri_arr[prev] + (bri_arr[nxt] - bri_arr[prev]) * local_pct)
+    color_temp = int(tmp_arr[prev] + (tmp_arr[nxt] - tmp_arr[prev]) * local_pct)
 
     return brightness, color_temp
 
 
+def precompute_ramp(pct_arr, bri_arr, tmp_arr, duration_seconds):
+    """Precompute per-second brightness and color_temp for the whole ramp."""
+    # Allocate each table once at full size rather than growing it
+    brightness_arr = array('H', bytes(2 * duration_seconds))
+    temp_arr = array('H', bytes(2 * duration_seconds))
+    for i in range(duration_seconds):
+        brightness, color_temp = interpolate_curve(pct_arr, bri_arr, tmp_arr, (i / duration_seconds) * 100)
+        brightness_arr[i] = brightness
+        temp_arr[i] = color_temp
+    return brightness_arr, temp_arr
+
+
 def run_sunrise_ramp(bulb, duration_seconds):
     """Run the sunrise ramp on a bulb."""
     print(f"Starting sunrise ramp ({duration_seconds}s)...")
 
+    pct_arr, bri_arr, tmp_arr = get_curve()
+    brightness_arr, temp_arr = precompute_ramp(pct_arr, bri_arr, tmp_arr, duration_seconds)
+    gc.collect()
+
     bulb.connect()
-    brightness, color_temp = interpolate_curve(config.SUNRISE_CURVE, 0)
+    brightness, color_temp = interpolate_curve(pct_arr, bri_arr, tmp_arr, 0)
     bulb.set_white_mode(brightness, color_temp)
+    last_sent = (brightness, color_temp)
 
-    start = time.time()
+    # Hoist attribute lookups out of the per-second loop
+    set_white = bulb.set_white_mode
+    ticks_ms = time.ticks_ms
+    ticks_diff = time.ticks_diff
+    sleep_ms = machine.lightsleep if getattr(config, 'RAMP_LIGHT_SLEEP', False) else time.sleep_ms
+
+    # ticks_ms is monotonic, so an NTP resync can't skew the cadence
+    start = ticks_ms()
 
     for i in range(duration_seconds):
-        percent = (i / duration_seconds) * 100
-        brightness, color_temp = interpolate_curve(config.SUNRISE_CURVE, percent)
+        brightness = brightness_arr[i]
+        color_temp = temp_arr[i]
 
         try:
-            bulb.set_white_mode(brightness, color_temp)
+            # Consecutive seconds often round to the same values; skip the resend
+            if (brightness, color_temp) != last_sent:
+                set_white(brightness, color_temp)
+                last_sent = (brightness, color_temp)
         except Exception as e:
             print(f"Error setting bulb: {e}")
+            last_sent = None
             try:
                 bulb.connect()
             except:
                 pass
 
         if i % 60 == 0:
+            percent = (i / duration_seconds) * 100
             print(f"  {i}s: {percent:.0f}% brightness={brightness} temp={color_temp}")
-            gc.collect()
 
-        elapsed = time.time() - start
-        sleep_time = (i + 1) - elapsed
-        if sleep_time > 0:
-            time.sleep(sleep_time)
+        remaining_ms = (i + 1) * 1000 - ticks_diff(ticks_ms(), start)
+        if remaining_ms > 0:
+            sleep_ms(remaining_ms)
 
-    brightness, color_temp = interpolate_curve(config.SUNRISE_CURVE, 100)
+    brightness, color_temp = interpolate_curve(pct_arr, bri_arr, tmp_arr, 100)
     bulb.set_white_mode(brightness, color_temp)
     bulb.close()
+    gc.collect()
 
     print("Sunrise ramp complete!")
 
@@ -152,22 +381,53 @@ def get_current_time():
     return (hour, dt[5], dt[6])
 
 
+@micropython.native
 def time_to_seconds(h, m, s):
     """Convert time to seconds since midnight."""
     return h * 3600 + m * 60 + s
 
 
+DEEP_SLEEP_WAKE_SECS = 60  # Wake this long before the ramp starts
+DEEP_SLEEP_MIN_SECS = 120  # Not worth a reboot for less than this
+DEEP_SLEEP_MAX_SECS = 3600  # Wake at least hourly to re-check
+DEEP_SLEEP_RETRY_SECS = 30  # Retry interval after a failed WiFi join on wake
+
+
+def load_state():
+    """Restore main loop state saved in RTC memory before deep sleep."""
+    if machine.reset_cause() != machine.DEEPSLEEP_RESET:
+        return {}
+    try:
+        return json.loads(RTC().memory())
+    except ValueError:
+        return {}
+
+
+def save_state(state):
+    """Save main loop state to RTC memory so it survives deep sleep."""
+    RTC().memory(json.dumps(state))
+
+
 def main():
     print("\n=== Sunrise Alarm ESP32 ===\n")
 
+    # Collect incrementally as the heap fills rather than in long full passes
+    gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
+
     mode = getattr(config, 'MODE', 'sunrise')
     print(f"Mode: {mode}")
 
+    state = load_state()
     if not connect_wifi():
+        if machine.reset_cause() == machine.DEEPSLEEP_RESET:
+            # Don't strand a sleeping alarm on one failed join; try again shortly
+            print(f"WiFi failed, retrying in {DEEP_SLEEP_RETRY_SECS}s")
+            save_state(state)
+            machine.deepsleep(DEEP_SLEEP_RETRY_SECS * 1000)
         print("Cannot continue without WiFi")
         return
 
-    if not sync_time():
+    if sync_due(state) and not sync_time(state):
         print("Warning: time may be inaccurate")
 
     bulbs = []
@@ -177,13 +437,17 @@ def main():
 
     print(f"\nConfigured {len(bulbs)} bulb(s)")
 
-    sunrise_time = None
-    ramp_triggered_today = False
-    last_hour = -1
+    deep_sleep = getattr(config, 'DEEP_SLEEP', False)
+    sunrise_time = state.get("sunrise")
+    sunrise_date = state.get("sunrise_date")
+    ramp_triggered_today = state.get("triggered", False)
 
     while True:
         gc.collect()
 
+        if sync_due(state):
+            sync_time(state)
+
         now = get_current_time()
         now_secs = time_to_seconds(*now)
 
@@ -191,9 +455,11 @@ def main():
             # Static mode: fixed start time from config
             ramp_start_secs = time_to_seconds(config.STATIC_START_HOUR, config.STATIC_START_MINUTE, 0)
         else:
-            # Sunrise mode: fetch sunrise and calculate offset
-            if sunrise_time is None or (now[0] == 3 and now[1] == 0 and last_hour != 3):
+            # Sunrise mode: fetch sunrise (refreshed from 3 AM each day) and calculate offset
+            today = local_date_str()
+            if sunrise_time is None or (now[0] >= 3 and sunrise_date != today):
                 sunrise_time = get_sunrise_time()
+                sunrise_date = today
                 ramp_triggered_today = False
 
             sunrise_secs = time_to_seconds(*sunrise_time)
@@ -201,8 +467,6 @@ def main():
             if ramp_start_secs < 0:
                 ramp_start_secs += 86400
 
-        last_hour = now[0]
-
         # Check if time to start ramp (within 30 second window)
         if not ramp_triggered_today and abs(now_secs - ramp_start_secs) < 30:
             print(f"\n*** ALARM at {now[0]:02d}:{now[1]:02d}:{now[2]:02d} ***\n")
@@ -226,6 +490,21 @@ def main():
             ramp_m = (ramp_start_secs % 3600) // 60
             print(f"[{now[0]:02d}:{now[1]:02d}] Next ramp: {ramp_h:02d}:{ramp_m:02d}, triggered: {ramp_triggered_today}")
 
+        # Deep sleep until shortly before the ramp unless it's about to start
+        # (or just started). main() runs again from boot on wake.
+        secs_to_ramp = (ramp_start_secs - now_secs) % 86400
+        secs_to_wake = secs_to_ramp - DEEP_SLEEP_WAKE_SECS
+        if deep_sleep and secs_to_wake > DEEP_SLEEP_MIN_SECS and secs_to_ramp < 86400 - 30:
+            state["sunrise"] = sunrise_time
+            state["sunrise_date"] = sunrise_date
+            state["triggered"] = ramp_triggered_today
+            save_state(state)
+            # The RTC slow clock drifts a few percent in deep sleep, so aim
+            # short and let later wakes close the gap
+            sleep_secs = min(secs_to_wake - secs_to_wake // 10, DEEP_SLEEP_MAX_SECS)
+            print(f"Deep sleeping for {sleep_secs}s")
+            machine.deepsleep(sleep_secs * 1000)
+
         time.sleep(10)
 
 
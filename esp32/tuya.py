@@ -1,27 +1,84 @@
 # Minimal Tuya local protocol implementation for MicroPython
 import socket
-import struct
-import json
+import ustruct as struct
+import ujson as json
+import micropython
+from array import array
 from ucryptolib import aes
 
+try:
+    from binascii import crc32 as _bi_crc32
+except ImportError:
+    # Some MicroPython builds ship binascii without crc32
+    _bi_crc32 = None
 
+
+@micropython.native
 def _pad(data):
     """PKCS7 padding for AES."""
     pad_len = 16 - (len(data) % 16)
     return data + bytes([pad_len] * pad_len)
 
 
-def _crc32(data):
-    """Calculate CRC32."""
-    crc = 0xffffffff
-    for byte in data:
-        crc ^= byte
+def _make_crc_table():
+    """Build the 256-entry lookup table for the reflected 0xedb88320 polynomial."""
+    table = array('I', [0] * 256)
+    for n in range(256):
+        crc = n
         for _ in range(8):
             if crc & 1:
                 crc = (crc >> 1) ^ 0xedb88320
             else:
                 crc >>= 1
-    return crc ^ 0xffffffff
+        table[n] = crc
+    return table
+
+
+# Both variants take an explicit length so the viper one can walk a raw pointer:
+# call as _crc32(buf, len(buf)).
+if _bi_crc32 is not None:
+    def _crc32(data, length):
+        """Calculate CRC32 (same reflected 0xedb88320 polynomial as zlib)."""
+        return _bi_crc32(data) & 0xffffffff
+else:
+    _CRC_TABLE = _make_crc_table()
+
+    @micropython.viper
+    def _crc32(data: ptr8, length: int) -> uint:
+        """Calculate CRC32 using the precomputed lookup table."""
+        table = ptr32(_CRC_TABLE)
+        crc = uint(0xffffffff)
+        for i in range(length):
+            crc = uint(table[(crc ^ uint(data[i])) & 0xff]) ^ (crc >> 8)
+        return crc ^ uint(0xffffffff)
+
+
+# Socket options applied after connecting, limited to the constants this port's
+# socket module exports. esp32's setsockopt dispatches on the option number
+# alone and only warns on unknown ones, so guessed numbers would set the wrong
+# option (e.g. 4 is SO_REUSEADDR there).
+_SOCKOPTS = tuple(
+    (getattr(socket, level), getattr(socket, opt), value)
+    for level, opt, value in (
+        ('SOL_SOCKET', 'SO_KEEPALIVE', 1),
+        ('IPPROTO_TCP', 'TCP_NODELAY', 1),
+        ('IPPROTO_TCP', 'TCP_KEEPIDLE', 30),
+        ('IPPROTO_TCP', 'TCP_KEEPINTVL', 10),
+        ('IPPROTO_TCP', 'TCP_KEEPCNT', 3),
+        ('SOL_SOCKET', 'SO_SNDBUF', 512),  # Commands are < 256 bytes
+    )
+    if getattr(socket, level, None) is not None and getattr(socket, opt, None) is not None
+)
+
+
+# Packet framing: 16-byte header (prefix, seq, cmd, length), 3.3 version
+# header, encrypted payload, CRC, suffix
+_PREFIX = 0x000055aa
+_SUFFIX = 0x0000aa55
+_CMD_SET = 0x07
+_VERSION_33_HEADER = b'3.3' + b'\x00' * 12
+_HEADER_LEN = 16
+_PAYLOAD_START = _HEADER_LEN + len(_VERSION_33_HEADER)
 
 
 class TuyaBulb:
@@ -33,6 +90,15 @@ class TuyaBulb:
         self.seq_num = 0
         self.sock = None
 
+        # ECB carries no state between blocks, so one encrypt-only cipher is reusable
+        self._key_bytes = local_key.encode()
+        self._cipher = aes(self._key_bytes, 1)  # Mode 1 = ECB
+
+        # Packets are assembled in place; the version header never changes
+        self._buf = bytearray(256)
+        self._mv = memoryview(self._buf)
+        self._buf[_HEADER_LEN:_PAYLOAD_START] = _VERSION_33_HEADER
+
     def connect(self):
         """Connect to the device."""
         if self.sock:
@@ -44,6 +110,15 @@ class TuyaBulb:
         self.sock.settimeout(5)
         self.sock.connect((self.ip, 6668))
 
+        # Detect a dropped bulb quickly, don't let Nagle hold back small packets
+        # and keep the send buffer small.
+        # A port may still reject an exported option, so failures are ignored.
+        for level, opt, value in _SOCKOPTS:
+            try:
+                self.sock.setsockopt(level, opt, value)
+            except (OSError, TypeError):
+                pass
+
     def close(self):
         """Close connection."""
         if self.sock:
@@ -54,33 +129,33 @@ class TuyaBulb:
             self.sock = None
 
     def _send_command(self, dps):
-        """Send a SET command with the given data points."""
+        """Send a SET command with the given data points (dict or JSON string)."""
         self.seq_num += 1
 
         # Build payload
-        payload = json.dumps({
-            'devId': self.device_id,
-            'uid': self.device_id,
-            't': '0',
-            'dps': dps
-        }, separators=(',', ':'))
+        if not isinstance(dps, str):
+            dps = json.dumps(dps, separators=(',', ':'))
+        payload = '{"devId":"%s","uid":"%s","t":"0","dps":%s}' % (self.device_id, self.device_id, dps)
 
         # Encrypt
-        cipher = aes(self.local_key.encode(), 1)  # Mode 1 = ECB
-        encrypted = cipher.encrypt(_pad(payload.encode()))
-
-        # Add version header for 3.3
-        encrypted = b'3.3' + b'\x00' * 12 + encrypted
+        encrypted = self._cipher.encrypt(_pad(payload.encode()))
 
         # Build packet
-        cmd = 0x07  # SET command
-        length = len(encrypted) + 8
-        header = struct.pack('>IIII', 0x000055aa, self.seq_num, cmd, length)
-        crc = _crc32(header[4:] + encrypted)
-        packet = header + encrypted + struct.pack('>I', crc) + struct.pack('>I', 0x0000aa55)
+        end = _PAYLOAD_START + len(encrypted)
+        total_len = end + 8
+        if total_len > len(self._buf):
+            self._buf = bytearray(total_len)
+            self._mv = memoryview(self._buf)
+            self._buf[_HEADER_LEN:_PAYLOAD_START] = _VERSION_33_HEADER
+
+        length = end - _HEADER_LEN + 8
+        struct.pack_into('>IIII', self._buf, 0, _PREFIX, self.seq_num, _CMD_SET, length)
+        self._buf[_PAYLOAD_START:end] = encrypted
+        crc = _crc32(self._mv[4:end], end - 4)
+        struct.pack_into('>II', self._buf, end, crc, _SUFFIX)
 
         # Send and receive
-        self.sock.send(packet)
+        self.sock.sendall(self._mv[:total_len])
         response = self.sock.recv(1024)
 
         # Check return code
@@ -91,19 +166,14 @@ class TuyaBulb:
 
     def turn_on(self):
         """Turn bulb on."""
-        return self._send_command({'20': True})
+        return self._send_command('{"20":true}')
 
     def turn_off(self):
         """Turn bulb off."""
-        return self._send_command({'20': False})
+        return self._send_command('{"20":false}')
 
     def set_white_mode(self, brightness, color_temp):
         """Set white mode with brightness and color temp."""
         brightness = max(10, min(1000, int(brightness)))
         color_temp = max(0, min(1000, int(color_temp)))
-        return self._send_command({
-            '20': True,
-            '21': 'white',
-            '22': brightness,
-            '23': color_temp
-        })
+        return self._send_command('{"20":true,"21":"white","22":%d,"23":%d}' % (brightness, color_temp))
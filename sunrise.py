@@ -10,14 +10,19 @@ Usage:
 
 import argparse
 import json
+import math
 import time
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 import urllib.request
 
 import tinytuya
 
 CONFIG_PATH = Path(__file__).parent / "config.json"
+SUNRISE_CACHE_PATH = Path(__file__).parent / "sunrise_cache.json"
+SUNRISE_CACHE_DAYS = 7
 
 
 def load_config():
@@ -26,28 +31,96 @@ def load_config():
         return json.load(f)
 
 
-def get_sunrise_time(lat: float, lon: float, date: datetime = None) -> datetime:
-    """Fetch sunrise time from sunrise-sunset.org API."""
-    if date is None:
-        date = datetime.now()
+def load_sunrise_cache(lat: float, lon: float) -> dict:
+    """Load cached UTC sunrise timestamps for this location, keyed by date."""
+    try:
+        with open(SUNRISE_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get("location") != [lat, lon]:
+        return {}
+    return cache.get("sunrise", {})
 
-    url = f"https://api.sunrise-sunset.org/json?lat={lat}&lng={lon}&date={date.strftime('%Y-%m-%d')}&formatted=0"
 
+def save_sunrise_cache(lat: float, lon: float, sunrise: dict):
+    """Write cached sunrise timestamps for this location."""
     try:
-        with urllib.request.urlopen(url, timeout=10) as response:
-            data = json.loads(response.read().decode())
-            if data["status"] == "OK":
-                # Parse ISO format and convert to local time
-                sunrise_utc = datetime.fromisoformat(data["results"]["sunrise"].replace("Z", "+00:00"))
-                # Convert to naive datetime in local time
-                sunrise_local = sunrise_utc.astimezone().replace(tzinfo=None)
-                return sunrise_local
-    except Exception as e:
-        print(f"Failed to fetch sunrise time: {e}")
+        with open(SUNRISE_CACHE_PATH, "w") as f:
+            json.dump({"location": [lat, lon], "sunrise": sunrise}, f, indent=2)
+    except OSError as e:
+        print(f"Failed to write sunrise cache: {e}")
+
+
+def fetch_sunrise_utc(lat: float, lon: float, day: datetime) -> Optional[str]:
+    """Fetch the UTC sunrise timestamp for a date from sunrise-sunset.org API."""
+    url = f"https://api.sunrise-sunset.org/json?lat={lat}&lng={lon}&date={day.strftime('%Y-%m-%d')}&formatted=0"
+
+    with urllib.request.urlopen(url, timeout=10) as response:
+        data = json.loads(response.read().decode())
+    if data["status"] != "OK":
+        return None
+    return data["results"]["sunrise"]
+
+
+@lru_cache(maxsize=8)
+def compute_sunrise(lat: float, lon: float, day: date) -> datetime:
+    """Compute the UTC sunrise for a date from NOAA's solar equations.
+
+    Raises ValueError when the sun doesn't rise or set that day (polar regions).
+    """
+    g = 2 * math.pi / 365 * (day.timetuple().tm_yday - 1)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(g) - 0.032077 * math.sin(g)
+                       - 0.014615 * math.cos(2 * g) - 0.040849 * math.sin(2 * g))
+    decl = (0.006918 - 0.399912 * math.cos(g) + 0.070257 * math.sin(g)
+            - 0.006758 * math.cos(2 * g) + 0.000907 * math.sin(2 * g)
+            - 0.002697 * math.cos(3 * g) + 0.00148 * math.sin(3 * g))
+
+    lat_r = math.radians(lat)
+    cos_ha = math.cos(math.radians(90.833)) / (math.cos(lat_r) * math.cos(decl)) - math.tan(lat_r) * math.tan(decl)
+    ha = math.degrees(math.acos(cos_ha))
+
+    minutes = 720 - 4 * (lon + ha) - eqtime
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(minutes=minutes)
+
+
+def get_sunrise_time(lat: float, lon: float, day: datetime = None) -> datetime:
+    """Get sunrise time, computed offline with the sunrise-sunset.org API as fallback."""
+    if day is None:
+        day = datetime.now()
+
+    try:
+        sunrise_utc = compute_sunrise(lat, lon, day.date())
+        return sunrise_utc.astimezone().replace(tzinfo=None)
+    except ValueError:
+        pass
+
+    key = day.strftime('%Y-%m-%d')
+    cache = load_sunrise_cache(lat, lon)
+
+    if key not in cache:
+        fetched = {}
+        for offset in range(SUNRISE_CACHE_DAYS):
+            fetch_day = day + timedelta(days=offset)
+            try:
+                sunrise = fetch_sunrise_utc(lat, lon, fetch_day)
+            except Exception as e:
+                print(f"Failed to fetch sunrise time: {e}")
+                break
+            if sunrise is None:
+                break
+            fetched[fetch_day.strftime('%Y-%m-%d')] = sunrise
+        if fetched:
+            cache = fetched
+            save_sunrise_cache(lat, lon, cache)
+
+    if key not in cache:
         # Fallback to 7:00 AM
         return datetime.now().replace(hour=7, minute=0, second=0, microsecond=0)
 
-    return None
+    # Parse ISO format and convert to naive datetime in local time
+    sunrise_utc = datetime.fromisoformat(cache[key].replace("Z", "+00:00"))
+    return sunrise_utc.astimezone().replace(tzinfo=None)
 
 
 def connect_bulb(device: dict) -> tinytuya.BulbDevice:
@@ -124,6 +197,7 @@ def run_sunrise_ramp(device: dict, duration_seconds: int, config: dict):
     # Set initial state from curve (single command turns on + sets brightness)
     brightness, color_temp = interpolate_curve(curve, 0)
     set_bulb_white(bulb, brightness, color_temp)
+    last_sent = (brightness, color_temp)
 
     print(f"  Starting sunrise ramp for {device['name']} ({duration_seconds}s)")
 
@@ -133,10 +207,14 @@ def run_sunrise_ramp(device: dict, duration_seconds: int, config: dict):
         percent = (i / duration_seconds) * 100
         brightness, color_temp = interpolate_curve(curve, percent)
 
-        try:
-            set_bulb_white(bulb, brightness, color_temp)
-        except Exception as e:
-            print(f"  Warning: Failed to update bulb: {e}")
+        # Only send when the interpolated values actually changed
+        if (brightness, color_temp) != last_sent:
+            try:
+                set_bulb_white(bulb, brightness, color_temp)
+                last_sent = (brightness, color_temp)
+            except Exception as e:
+                print(f"  Warning: Failed to update bulb: {e}")
+                last_sent = None
 
         # Sleep until next second
         target_time = start_time + i + 1